@@ -1,9 +1,27 @@
 import streamlit as st
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.stats import norm
+from scipy.special import ndtr, ndtri
 from io import BytesIO   # ✅ ADICIONE ESTA LINHA
+import math
+import threading
+from typing import NamedTuple
+
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:  # sem numba, os núcleos rodam em Python puro
+    _HAS_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+try:
+    import numexpr as ne
+except ImportError:  # sem numexpr, as expressões vetorizadas ficam em NumPy puro
+    ne = None
 
 
 st.set_page_config(page_title="Insumos do Shopping – Otimização de Estoques", layout="wide")
@@ -122,6 +140,17 @@ aba = st.radio("Escolha uma seção:", [
 # ---------------------------
 # FUNÇÕES AUXILIARES
 # ---------------------------
+def fmt0(x):
+    """Número com separador de milhar e sem casas decimais."""
+    return f"{x:,.0f}"
+
+def fmt2(x):
+    """Número com separador de milhar e duas casas decimais."""
+    return f"{x:,.2f}"
+
+# z para os níveis de serviço inteiros dos sliders (80% … 99%): índice = SL − 80
+_Z_TABLE = ndtri(np.arange(80, 100, dtype=np.float64) / 100.0)
+
 def eoq(D_per, K, h_per):
     """EOQ na base de tempo escolhida (período = semana ou mês)."""
     if D_per <= 0 or K < 0 or h_per <= 0:
@@ -155,78 +184,584 @@ def lead_time_stats_from_base(D_base, sigma_base, L_dias, base="mensal"):
     return mu_L, sigma_L, d_dia, sigma_d_dia
 
 def ajusta_por_moq_multiplo(q, moq=0, mult=0):
-    if q is None or np.isnan(q):
+    if q is None or q != q:  # None ou NaN
         return q
     q_adj = q
     if moq and moq > 0 and q_adj < moq:
         q_adj = moq
     if mult and mult > 0:
-        q_adj = mult * np.ceil(q_adj / mult)
+        # MOQ e múltiplo são inteiros (number_input com step inteiro): teto da
+        # divisão só com aritmética inteira
+        q_adj = ((math.ceil(q_adj) + mult - 1) // mult) * mult
     return q_adj
 
-def sim_serrilhado_com_leadtime(Q, r, d_dia, L, sigma_d_dia=0.0, T=180,
-                                seed=42, clamp_zero=True, start_mode="steady"):
+# Versões vetorizadas (uma linha por SKU) usadas no Multi-SKU. Mantêm a mesma
+# semântica das escalares acima, inclusive para NaN vindo da planilha.
+def eoq_vet(D_per, K, h_per):
+    """EOQ elemento a elemento; NaN onde os parâmetros são inválidos."""
+    if ne is not None:  # expressão fundida, avaliada em blocos (sem temporários)
+        Q = ne.evaluate("sqrt((2.0 * K * D_per) / h_per)")
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            Q = np.sqrt((2.0 * K * D_per) / h_per)
+    return np.where((D_per <= 0) | (K < 0) | (h_per <= 0), np.nan, Q)
+
+def custos_periodicos_vet(Q, D_per, K, h_per, SS=0.0):
+    """Como custos_periodicos, para arrays. Retorna (c_ped, c_pos, c_tot)."""
+    invalido = (Q <= 0) | (D_per <= 0) | (h_per < 0) | (K < 0)
+    SS_pos = np.where(SS > 0.0, SS, 0.0)  # max(0, SS); SS NaN → 0
+    if ne is not None:
+        c_ped = ne.evaluate("K * D_per / Q")
+        c_pos = ne.evaluate("h_per * (Q / 2.0 + SS_pos)")
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            c_ped = K * D_per / Q
+            c_pos = h_per * (Q / 2.0 + SS_pos)
+    c_ped = np.where(invalido, np.nan, c_ped)
+    c_pos = np.where(invalido, np.nan, c_pos)
+    return c_ped, c_pos, c_ped + c_pos
+
+def ajusta_por_moq_multiplo_vet(q, moq, mult):
+    """Arredonda cada q para cima do MOQ e do múltiplo (0 = sem restrição)."""
+    q = np.where((moq > 0) & (q < moq), moq, q)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(mult > 0, mult * np.ceil(q / mult), q)
+
+def multi_sku_numpy(D_per, sigma_per, v, i_anual, K, L, SL, moq, mult, Qb_in, rb_in,
+                    denom, periods_per_year, heuristica, aplicar_restricoes):
+    """
+    Política (Q, r) ótima e baseline para todos os SKUs de uma vez (arrays 1-D).
+    denom: dias por período da base (30 = mensal, 7 = semanal).
+    heuristica: 0 = Q₀ = D, 1 = Q₀ = 2·D, 2 = Q₀ = EOQ ajustado.
+    Retorna (Q_opt, r_opt, SS_opt, Q_base, r_base, ctot_opt, ctot_base,
+             economia_per, economia_ano, economia_pct).
     """
-    Simula política (Q, r) com lead time L e demanda ~ Normal(d_dia, sigma_d_dia).
+    moq_eff = moq if aplicar_restricoes else np.zeros_like(moq)
+    mult_eff = mult if aplicar_restricoes else np.zeros_like(mult)
+
+    h_per = (i_anual * v) / periods_per_year
+    # Estatísticas no lead time (como lead_time_stats_from_base), com √denom
+    # calculada uma vez e as operações feitas no próprio buffer
+    mu_L = D_per / denom
+    mu_L *= L
+    sigma_L = np.maximum(L, 1.0)
+    np.sqrt(sigma_L, out=sigma_L)
+    sigma_L *= sigma_per / math.sqrt(denom)
+    # poucos níveis de serviço distintos no catálogo: ndtri só uma vez por SL
+    sl_unicos, idx_sl = np.unique(SL, return_inverse=True)
+    z = ndtri(np.clip(sl_unicos / 100.0, 0.01, 0.999))[idx_sl]
+    SS_opt = z * sigma_L; r_opt = mu_L + SS_opt
+
+    Q_opt_raw = eoq_vet(D_per, K, h_per)
+    Q_opt = ajusta_por_moq_multiplo_vet(Q_opt_raw, moq_eff, mult_eff)
+
+    if heuristica == 0:   Q_heur = D_per
+    elif heuristica == 1: Q_heur = 2.0 * D_per
+    else:                 Q_heur = Q_opt
+    Q_base = np.where(Qb_in > 0, Qb_in, Q_heur)
+    if aplicar_restricoes:
+        Q_base = ajusta_por_moq_multiplo_vet(Q_base, moq, mult)
+
+    usa_rb = rb_in > 0
+    SS_base = np.where(usa_rb, rb_in - mu_L, SS_opt)
+    SS_base[usa_rb & ~(SS_base > 0.0)] = 0.0  # max(0, r₀ − μ_L)
+    r_base = np.where(usa_rb, rb_in, r_opt)
+
+    ctot_opt = custos_periodicos_vet(Q_opt, D_per, K, h_per, SS=SS_opt)[2]
+    ctot_base = custos_periodicos_vet(Q_base, D_per, K, h_per, SS=SS_base)[2]
+
+    finitos = np.isfinite(ctot_base) & np.isfinite(ctot_opt)
+    economia_per = np.where(finitos, ctot_base - ctot_opt, np.nan)
+    economia_ano = economia_per * periods_per_year
+    with np.errstate(divide="ignore", invalid="ignore"):
+        economia_pct = np.where(np.isfinite(ctot_base) & (ctot_base > 0), economia_per / ctot_base * 100.0, np.nan)
+    return (Q_opt, r_opt, SS_opt, Q_base, r_base, ctot_opt, ctot_base,
+            economia_per, economia_ano, economia_pct)
+
+# Coeficientes do ndtri da Cephes (mesma rotina que scipy.special.ndtri usa),
+# para calcular z dentro do núcleo numba sem sair do modo nopython
+_NDTRI_P0 = np.array([-5.99633501014107895267E1, 9.80010754185999661536E1, -5.66762857469070293439E1,
+                      1.39312609387279679503E1, -1.23916583867381258016E0])
+_NDTRI_Q0 = np.array([1.95448858338141759834E0, 4.67627912898881538453E0, 8.63602421390890590575E1,
+                      -2.25462687854119370527E2, 2.00260212380060660359E2, -8.20372256168333339912E1,
+                      1.59056225126211695515E1, -1.18331621121330003142E0])
+_NDTRI_P1 = np.array([4.05544892305962419923E0, 3.15251094599893866154E1, 5.71628192246421288162E1,
+                      4.40805073893200834700E1, 1.46849561928858024014E1, 2.18663306850790267539E0,
+                      -1.40256079171354495875E-1, -3.50424626827848203418E-2, -8.57456785154685413611E-4])
+_NDTRI_Q1 = np.array([1.57799883256466749731E1, 4.53907635128879210584E1, 4.13172038254672030440E1,
+                      1.50425385692907503408E1, 2.50464946208309415979E0, -1.42182922854787788574E-1,
+                      -3.80806407691578277194E-2, -9.33259480895457427372E-4])
+_NDTRI_P2 = np.array([3.23774891776946035970E0, 6.91522889068984211695E0, 3.93881025292474443415E0,
+                      1.33303460815807542389E0, 2.01485389549179081538E-1, 1.23716634817820021358E-2,
+                      3.01581553508235416007E-4, 2.65806974686737550832E-6, 6.23974539184983293730E-9])
+_NDTRI_Q2 = np.array([6.02427039364742014255E0, 3.67983563856160859403E0, 1.37702099489081330271E0,
+                      2.16236993594496635890E-1, 1.34204006088543189037E-2, 3.28014464682127739104E-4,
+                      2.89247864745380683936E-6, 6.79019408009981274425E-9])
+
+@njit(cache=True)
+def _polevl(x, coef):
+    ans = coef[0]
+    for c in coef[1:]:
+        ans = ans * x + c
+    return ans
+
+@njit(cache=True)
+def _p1evl(x, coef):
+    ans = x + coef[0]
+    for c in coef[1:]:
+        ans = ans * x + c
+    return ans
+
+@njit(cache=True)
+def _ndtri_nb(y0):
+    """Inversa da normal padrão (Cephes ndtri), escalar."""
+    if y0 == 0.0:
+        return -np.inf
+    if y0 == 1.0:
+        return np.inf
+    if not (0.0 < y0 < 1.0):  # fora do domínio ou NaN
+        return np.nan
+    exp_m2 = 0.13533528323661269189  # exp(-2)
+    negativo = True
+    y = y0
+    if y > 1.0 - exp_m2:
+        y = 1.0 - y
+        negativo = False
+    if y > exp_m2:
+        y = y - 0.5
+        y2 = y * y
+        x = y + y * (y2 * _polevl(y2, _NDTRI_P0) / _p1evl(y2, _NDTRI_Q0))
+        return x * 2.50662827463100050242  # sqrt(2π)
+    x = np.sqrt(-2.0 * np.log(y))
+    x0 = x - np.log(x) / x
+    z = 1.0 / x
+    if x < 8.0:
+        x1 = z * _polevl(z, _NDTRI_P1) / _p1evl(z, _NDTRI_Q1)
+    else:
+        x1 = z * _polevl(z, _NDTRI_P2) / _p1evl(z, _NDTRI_Q2)
+    x = x0 - x1
+    return -x if negativo else x
+
+@njit(cache=True)
+def _ajusta_nb(q, moq, mult):
+    if moq > 0 and q < moq:
+        q = moq
+    if mult > 0:
+        q = mult * np.ceil(q / mult)
+    return q
+
+@njit(cache=True)
+def _custo_total_nb(Q, D_per, K, h_per, SS):
+    if Q <= 0 or D_per <= 0 or h_per < 0 or K < 0:
+        return np.nan
+    return K * D_per / Q + h_per * (Q / 2.0 + (SS if SS > 0.0 else 0.0))
+
+# A partir de quantos SKUs o Multi-SKU troca o NumPy vetorizado pelo núcleo numba
+_LIMIAR_NUMBA = 200_000
+# O kernel paralelo não pode ser chamado por duas sessões ao mesmo tempo: a camada
+# de threads "workqueue" (padrão sem TBB/OpenMP) aborta o processo nesse caso.
+_NUMBA_LOCK = threading.Lock()
+
+@njit(cache=True, parallel=True)
+def _multi_sku_numba(D_per, sigma_per, v, i_anual, K, L, SL, moq, mult, Qb_in, rb_in,
+                     denom, periods_per_year, heuristica, aplicar_restricoes):
+    """Mesmo cálculo de multi_sku_numpy, um SKU por iteração (prange)."""
+    n = D_per.shape[0]
+    Q_opt = np.empty(n); r_opt = np.empty(n); SS_opt = np.empty(n)
+    Q_base = np.empty(n); r_base = np.empty(n)
+    ctot_opt = np.empty(n); ctot_base = np.empty(n)
+    eco_per = np.empty(n); eco_ano = np.empty(n); eco_pct = np.empty(n)
+    raiz_denom = np.sqrt(denom)
+    for i in prange(n):
+        D = D_per[i]; Ki = K[i]; Li = L[i]
+        h = (i_anual[i] * v[i]) / periods_per_year
+        mu_L = (D / denom) * Li
+        sigma_L = (sigma_per[i] / raiz_denom) * np.sqrt(1.0 if Li < 1 else Li)
+        p = SL[i] / 100.0
+        if p < 0.01:
+            p = 0.01
+        elif p > 0.999:
+            p = 0.999
+        z = _ndtri_nb(p)
+        SS_opt[i] = z * sigma_L
+        r_opt[i] = mu_L + SS_opt[i]
+
+        if D <= 0 or Ki < 0 or h <= 0:
+            q_raw = np.nan
+        else:
+            q_raw = np.sqrt((2.0 * Ki * D) / h)
+        moq_i = moq[i] if aplicar_restricoes else 0.0
+        mult_i = mult[i] if aplicar_restricoes else 0.0
+        Q_opt[i] = _ajusta_nb(q_raw, moq_i, mult_i)
+
+        if Qb_in[i] > 0:
+            qb = Qb_in[i]
+        elif heuristica == 0:
+            qb = D
+        elif heuristica == 1:
+            qb = 2.0 * D
+        else:
+            qb = Q_opt[i]
+        if aplicar_restricoes:
+            qb = _ajusta_nb(qb, moq[i], mult[i])
+        Q_base[i] = qb
+
+        if rb_in[i] > 0:
+            ss_b = rb_in[i] - mu_L
+            if not (ss_b > 0.0):
+                ss_b = 0.0
+            r_base[i] = rb_in[i]
+        else:
+            ss_b = z * sigma_L
+            r_base[i] = mu_L + ss_b
+
+        c_opt = _custo_total_nb(Q_opt[i], D, Ki, h, SS_opt[i])
+        c_base = _custo_total_nb(qb, D, Ki, h, ss_b)
+        ctot_opt[i] = c_opt; ctot_base[i] = c_base
+        if np.isfinite(c_base) and np.isfinite(c_opt):
+            eco_per[i] = c_base - c_opt
+        else:
+            eco_per[i] = np.nan
+        eco_ano[i] = eco_per[i] * periods_per_year
+        if np.isfinite(c_base) and c_base > 0:
+            eco_pct[i] = eco_per[i] / c_base * 100.0
+        else:
+            eco_pct[i] = np.nan
+    return (Q_opt, r_opt, SS_opt, Q_base, r_base, ctot_opt, ctot_base,
+            eco_per, eco_ano, eco_pct)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def ranking_top_n(_df_out, chave, ordenar_por, filtro_texto, k, colunas_metricas):
+    """
+    Top-k do ranking (filtro aplicado antes, nlargest em vez de ordenar tudo), o
+    índice do conjunto filtrado (para a exportação completa) e as métricas (soma,
+    soma, média) desse conjunto. _df_out não entra no hash: `chave` identifica o
+    arquivo e os parâmetros que o geraram.
+    """
+    df = _df_out
+    if filtro_texto:
+        # busca só nas categorias (SKUs distintos) e espalha pelos códigos;
+        # o False extra atende o código −1 (SKU vazio)
+        sku = df["SKU"]
+        hit = sku.cat.categories.str.contains(filtro_texto, case=False, regex=False, na=False)
+        mask = np.append(np.asarray(hit, dtype=bool), False)[sku.cat.codes.to_numpy()]
+        df = df[mask]
+    top = df.nlargest(k, ordenar_por)  # NaN vão para o fim, como no sort_values
+
+    c_per, c_ano, c_pct = colunas_metricas
+    metricas = (df[[c_per, c_ano, c_pct]].replace([np.inf, -np.inf], np.nan)
+                .agg({c_per: "sum", c_ano: "sum", c_pct: "mean"}))
+    return top.reset_index(drop=True), df.index, tuple(metricas.to_numpy())
+
+@njit(cache=True)
+def _sim_core_batch(Q, r, L, demand, steady, clamp_zero):
+    """
+    Núcleo numérico da simulação (Q, r) para N políticas de uma vez.
+    Q, r: arrays (N,); demand: (N, T). Só recebe números e arrays.
+    Retorna (y_onhand, y_pos, order_mask, arrival_mask) em (N, T+1) e stockout_days (N,);
+    as trajetórias saem em float32.
+    """
+    N, T = demand.shape
+    n_slots = L + 1
+
+    # trajetórias só servem para gráfico/KPIs: float32 basta (estado interno segue em float64)
+    y_onhand = np.empty((N, T + 1), dtype=np.float32)
+    y_pos = np.empty((N, T + 1), dtype=np.float32)
+    order_mask = np.zeros((N, T + 1), dtype=np.bool_)
+    arrival_mask = np.zeros((N, T + 1), dtype=np.bool_)
+    stockout_days = np.zeros(N, dtype=np.int64)
+
+    # Pipeline circular: o slot t % (L+1) guarda o que chega no dia t
+    # on_order acompanha a soma do pipeline de forma incremental (O(1) por dia)
+    pipeline = np.zeros((N, n_slots))
+    # pedidos pendentes por slot, separado da quantidade: com Q = 0 o pedido
+    # ainda "chega" (marca a chegada) mesmo sem somar nada ao estoque
+    pendentes = np.zeros((N, n_slots), dtype=np.int64)
+
+    for i in range(N):
+        if steady:
+            on_hand = r[i]
+            pipeline[i, L % n_slots] = Q[i]  # pedido emitido agora; chega em L
+            pendentes[i, L % n_slots] = 1
+            on_order = Q[i]
+        else:
+            on_hand = Q[i]
+            on_order = 0.0
+
+        y_onhand[i, 0] = on_hand
+        y_pos[i, 0] = on_hand  # posição inicial = on_hand (sem trânsito)
+        idx = np.int64(1 % n_slots)  # slot do dia t
+
+        for t in range(1, T + 1):
+            # 1) Chegadas
+            if pendentes[i, idx] > 0:
+                arrival = pipeline[i, idx]
+                pipeline[i, idx] = 0.0
+                pendentes[i, idx] = 0
+                on_hand += arrival
+                on_order -= arrival
+                arrival_mask[i, t] = True
+
+            # 2) Consumo
+            on_hand -= demand[i, t - 1]
+            if clamp_zero and on_hand < 0:
+                on_hand = 0.0
+                stockout_days[i] += 1
+
+            # 3) Posição de estoque
+            position = on_hand + on_order
+
+            # 4) Regra (Q, r): emite pedido que chegará em t+L
+            if position <= r[i]:
+                pipeline[i, (idx + L) % n_slots] += Q[i]
+                pendentes[i, (idx + L) % n_slots] += 1
+                on_order += Q[i]
+                order_mask[i, t] = True
+
+            y_onhand[i, t] = on_hand
+            y_pos[i, t] = position
+            idx = (idx + 1) % n_slots
+
+    return y_onhand, y_pos, order_mask, arrival_mask, stockout_days
+
+@njit(cache=True)
+def _kpis_core(y_on, SS):
+    """
+    KPIs do on-hand numa única passada.
+    Retorna (mín, máx, média, % dias abaixo de SS, % dias com ruptura).
+    """
+    n = y_on.shape[0]
+    v_min = y_on[0]
+    v_max = y_on[0]
+    total = 0.0
+    below_ss = 0
+    ruptura = 0
+    for i in range(n):
+        v = y_on[i]
+        if v < v_min:
+            v_min = v
+        if v > v_max:
+            v_max = v
+        total += v
+        if v < SS:
+            below_ss += 1
+        if v <= 0:
+            ruptura += 1
+    return v_min, v_max, total / n, 100.0 * below_ss / n, 100.0 * ruptura / n
+
+_RNG_LOCK = threading.Lock()
+_NOISE_BUF = np.empty((2, 1024))  # demanda (N, T) reaproveitada entre simulações; T ≤ 360 no app
+
+@st.cache_resource(show_spinner=False)
+def _get_rng(seed):
+    """Gerador criado uma única vez por semente; devolve também o estado inicial."""
+    rng = np.random.default_rng(seed)
+    return rng, rng.bit_generator.state
+
+def sim_serrilhado_lote(Qs, rs, d_dia, L, sigma_d_dia=0.0, T=180,
+                        seeds=(42,), clamp_zero=True, start_mode="steady"):
+    """
+    Simula N políticas (Q, r) com o mesmo lead time L e a mesma demanda média.
+    Cada política usa sua própria semente (mesma trajetória que se simulada sozinha).
 
     start_mode:
       - "steady": começa já em regime, com on_hand=r e 1 pedido emitido que chega em L
       - "lot":    começa com on_hand=Q e sem pedidos (ciclo inicial pode encostar em 0)
 
     Retorna:
-      x (dias), y_onhand, y_pos (posição), order_times, arrival_times, stockout_days
+      x (dias), y_onhand (N, T+1), y_pos (N, T+1), lista de order_times,
+      lista de arrival_times, stockout_days (N,)
     """
-    rng = np.random.default_rng(seed)
+    Qs = np.asarray(Qs, dtype=np.float64)
+    rs = np.asarray(rs, dtype=np.float64)
+
+    N = len(Qs)
+    # Geradores e buffer de ruído são compartilhados entre reruns/sessões: o lock
+    # cobre do sorteio até o fim do núcleo, que lê a demanda direto do buffer.
+    with _RNG_LOCK:
+        if N <= _NOISE_BUF.shape[0] and T <= _NOISE_BUF.shape[1]:
+            demand_all = _NOISE_BUF[:N, :T]
+        else:
+            demand_all = np.empty((N, T))
 
-    if start_mode == "steady":
-        on_hand = float(r)
-        pending = [(int(L), Q)]  # pedido emitido agora; chega em L
-    else:
-        on_hand = float(Q)
-        pending = []
-
-    x = [0.0]
-    y_onhand = [on_hand]
-    y_pos = [on_hand]  # posição inicial = on_hand (sem trânsito)
-    order_times = []
-    arrival_times = []
-    stockout_days = 0
-
-    for t in range(1, T + 1):
-        # 1) Chegadas
-        if pending:
-            arrived = [q for (day, q) in pending if day == t]
-            if arrived:
-                on_hand += sum(arrived)
-                arrival_times.append(t)
-                pending = [(day, q) for (day, q) in pending if day != t]
-
-        # 2) Consumo
-        demand = d_dia if sigma_d_dia <= 0 else max(0.0, rng.normal(d_dia, sigma_d_dia))
-        on_hand -= demand
-        if clamp_zero and on_hand < 0:
-            on_hand = 0.0
-            stockout_days += 1
-
-        # 3) Posição de estoque
-        on_order = sum(q for (_, q) in pending) if pending else 0.0
-        position = on_hand + on_order
-
-        # 4) Regra (Q, r): emite pedido que chegará em t+L
-        if position <= r:
-            pending.append((t + int(L), Q))
-            order_times.append(t)
-
-        x.append(t)
-        y_onhand.append(on_hand)
-        y_pos.append(position)
+        # Demanda diária sorteada de uma vez (mesma sequência do sorteio dia a dia)
+        if sigma_d_dia <= 0:
+            demand_all.fill(float(d_dia))
+        else:
+            # volta cada gerador ao estado inicial: mesma semente ⇒ mesma trajetória
+            for i, seed in enumerate(seeds):
+                rng, estado_inicial = _get_rng(seed)
+                rng.bit_generator.state = estado_inicial
+                rng.standard_normal(out=demand_all[i])
+            demand_all *= sigma_d_dia
+            demand_all += d_dia
+            np.maximum(demand_all, 0.0, out=demand_all)
+
+        y_onhand, y_pos, order_mask, arrival_mask, stockout_days = _sim_core_batch(
+            Qs, rs, int(L), demand_all, start_mode == "steady", bool(clamp_zero)
+        )
 
+    x = np.arange(T + 1)
+    order_times = [np.flatnonzero(m) for m in order_mask]
+    arrival_times = [np.flatnonzero(m) for m in arrival_mask]
     return x, y_onhand, y_pos, order_times, arrival_times, stockout_days
 
+def kpis_analiticos(Q, r, mu_L, sigma_L, d_dia, T):
+    """
+    KPIs da política (Q, r) por fórmula fechada, com demanda Normal(mu_L, sigma_L)
+    no lead time — dispensa a simulação. T = horizonte em dias.
+    """
+    if sigma_L > 0:
+        z = (r - mu_L) / sigma_L
+        p_ruptura = 1.0 - ndtr(z)
+        # função de perda normal: E[(X − r)+] = σ_L·[φ(z) − z·(1 − Φ(z))]
+        phi = np.exp(-0.5 * z * z) / np.sqrt(2.0 * np.pi)
+        falta_ciclo = sigma_L * (phi - z * p_ruptura)
+    else:
+        p_ruptura = 1.0 if r < mu_L else 0.0
+        falta_ciclo = max(0.0, mu_L - r)
+    return {
+        "Pedidos no horizonte": T * d_dia / Q if Q > 0 else np.nan,
+        "Estoque médio (un)": Q / 2.0 + max(0.0, r - mu_L),
+        "Risco de ruptura por ciclo (%)": 100.0 * p_ruptura,
+        "Falta esperada por ciclo (un)": falta_ciclo,
+        "Fill rate (%)": 100.0 * (1.0 - falta_ciclo / Q) if Q > 0 else np.nan,
+    }
+
+class Politica(NamedTuple):
+    """Grandezas derivadas da política (Q, r) – ótimo e baseline."""
+    mu_L: float
+    sigma_L: float
+    d_dia: float
+    sigma_d_dia: float
+    z_opt: float
+    SS_opt: float
+    r_opt: float
+    z_base: float
+    SS_base: float
+    r_base: float
+    Q_opt_raw: float
+    Q_opt: float
+
+@st.cache_data(show_spinner=False)
+def calcula_politica(D_base, sigma_base, L_dias, base_key, SL_opt, SL_base,
+                     K, h_per, moq=0, mult=0, r_base_input=0):
+    """
+    Calcula uma única vez por combinação de entradas: estatísticas do lead time,
+    z/SS/r do ótimo e do baseline e o EOQ ajustado por MOQ/múltiplo.
+    SL_opt e SL_base são inteiros em % (80–99, como nos sliders).
+    """
+    mu_L, sigma_L, d_dia, sigma_d_dia = lead_time_stats_from_base(D_base, sigma_base, L_dias, base=base_key)
+    z_opt = float(_Z_TABLE[SL_opt - 80])
+    z_base = float(_Z_TABLE[SL_base - 80])
+    SS_opt = z_opt * sigma_L
+    r_opt = mu_L + SS_opt
+
+    if r_base_input and r_base_input > 0:
+        SS_base = max(0.0, r_base_input - mu_L)
+        r_base = r_base_input
+    else:
+        SS_base = z_base * sigma_L
+        r_base = mu_L + SS_base
+
+    # EOQ na base do período e ajustes práticos
+    Q_opt_raw = eoq(D_base, K, h_per)
+    Q_opt = ajusta_por_moq_multiplo(Q_opt_raw, moq=moq, mult=mult)
+
+    return Politica(mu_L, sigma_L, d_dia, sigma_d_dia, z_opt, SS_opt, r_opt,
+                    z_base, SS_base, r_base, Q_opt_raw, Q_opt)
+
+@st.cache_data(show_spinner=False)
+def _sim_cached(Qs, rs, d_dia, L, sigma_d_dia, T, seeds, start_mode):
+    """Versão memoizada da simulação em lote: só recalcula quando algum parâmetro muda."""
+    return sim_serrilhado_lote(
+        Qs, rs, d_dia=d_dia, L=L, sigma_d_dia=sigma_d_dia,
+        T=T, seeds=seeds, start_mode=start_mode
+    )
+
+@st.cache_data(show_spinner=False)
+def _cost_grid_cached(Q_min, Q_max, D_per, K, h_per, SS, n=200):
+    """
+    Grade de Q e custo total por período (com SS) para o gráfico de custo vs Q.
+    Em float32: é só para desenhar (metade dos bytes enviados ao navegador).
+    """
+    Q_grid = np.linspace(Q_min, Q_max, n, dtype=np.float32)  # Q_min >= 1: sem divisão por zero
+    if D_per <= 0 or h_per < 0 or K < 0:
+        return Q_grid, np.full(n, np.nan, dtype=np.float32)
+    total_grid = K * D_per / Q_grid + h_per * (Q_grid / 2.0 + max(0.0, SS))
+    return Q_grid, total_grid.astype(np.float32, copy=False)
+
+def custo_semanal(Q, K, D_sem, h_sem, SS=0.0):
+    """Custo semanal de pedidos, de posse (com SS) e total; Q pode ser escalar ou array."""
+    C_ped = K * D_sem / Q
+    C_pos = h_sem * (Q / 2.0 + SS)
+    return C_ped, C_pos, (C_ped + C_pos)
+
+@st.cache_data(show_spinner=False)
+def eoq_curve(D_sem, K, i_ano, v, n=400):
+    """Curvas de custo do gráfico didático (aba Etapas) e o ponto ótimo (Q*, C*)."""
+    h_sem = (i_ano * v) / 52.0  # conversão para base semanal
+    Q = np.linspace(max(1, 0.05*D_sem), 8*D_sem, n)  # grade de Q (un)
+    C_pedido, C_posse, C_total = custo_semanal(Q, K, D_sem, h_sem)  # R$/semana
+
+    Q_opt = np.sqrt(2 * K * D_sem / h_sem)   # EOQ em unidades (base semanal)
+    C_opt = custo_semanal(Q_opt, K, D_sem, h_sem)[2]
+    return Q, C_pedido, C_posse, C_total, Q_opt, C_opt
+
+@st.cache_data(show_spinner=False)
+def exemplo_custo_grid(Q_min, Q_max, K, D_sem, h_sem, SS, n=250):
+    """Grade custo semanal total x Q do Exemplo Numérico."""
+    Q_grid = np.linspace(Q_min, Q_max, n)
+    C_grid = custo_semanal(Q_grid, K, D_sem, h_sem, SS)[2]
+    return Q_grid, C_grid
+
+# Figuras Matplotlib das abas didáticas: montadas uma vez e reaproveitadas entre
+# reruns/sessões. O savefig do st.pyplot não é thread-safe sobre a mesma figura.
+_FIG_LOCK = threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def make_eoq_plot(D_sem, K, i_ano, v):
+    """Figura das curvas de custo (base semanal) e do ponto ótimo (aba Etapas)."""
+    import matplotlib.pyplot as plt
+    Q, C_pedido, C_posse, C_total, Q_opt, C_opt = eoq_curve(D_sem, K, i_ano, v)
+
+    fig, ax = plt.subplots(figsize=(6,4))
+    ax.plot(Q, C_pedido, '--', label="Custo de Pedido (R$/sem)")
+    ax.plot(Q, C_posse, '--', label="Custo de Posse (R$/sem)")
+    ax.plot(Q, C_total, '-',  label="Custo Total (R$/sem)", linewidth=2)
+    ax.axvline(Q_opt, linestyle=':', label=f"Q* ≈ {Q_opt:,.0f} un")
+    ax.scatter([Q_opt], [C_opt], zorder=5)
+    ax.set_xlabel("Quantidade por Pedido (Q)  [un]")
+    ax.set_ylabel("Custo por Semana  [R$]")
+    ax.set_title("Curvas de Custo (base semanal) e Ponto Ótimo (EOQ)")
+    ax.legend()
+    plt.close(fig)  # fica só no cache, fora do registro global do pyplot
+    return fig
+
+@st.cache_resource(show_spinner=False)
+def make_exemplo_plot(Q_opt, Q_base, K, D_sem, h_sem, SS):
+    """Figura custo semanal vs. Q do Exemplo Numérico (ótimo x baseline)."""
+    import matplotlib.pyplot as plt
+    Q_grid, C_grid = exemplo_custo_grid(max(200, 0.2*Q_opt), 2.5*Q_base, K, D_sem, h_sem, SS)
+
+    fig, ax = plt.subplots(figsize=(8, 4))
+    ax.plot(Q_grid, C_grid, label="Custo semanal total (com SS)")
+    ax.axvline(Q_opt, ls='--', label=f"Q* ≈ {Q_opt:,.0f}")
+    ax.axvline(Q_base, ls=':', label=f"Q₀ (baseline) = {Q_base:,.0f}")
+    ax.set_xlabel("Tamanho do lote (Q)")
+    ax.set_ylabel("Custo por semana (R$)")
+    ax.set_title("Custo semanal vs. Q — Ótimo x Baseline")
+    ax.legend()
+    plt.close(fig)
+    return fig
+
 # ---------------------------
 # 🔧 CALCULADORA (1 SKU) – revisada
 # ---------------------------
 if aba == "🔧 Calculadora":
+    # imports pesados só na aba que os usa
+    import plotly.graph_objects as go
+
     base_tempo = st.sidebar.radio(
         "Escolha a base dos seus dados:",
         ["Mensal", "Semanal"], index=0,
@@ -356,24 +891,13 @@ if aba == "🔧 Calculadora":
     # Posição de estoque (use isto para decidir 'quando pedir')
     posicao_atual = on_hand_now + on_order_now - backorders_now
 
-    # Estatísticas do lead time (a partir da base escolhida)
-    mu_L_opt, sigma_L_opt, d_dia, sigma_d_dia = lead_time_stats_from_base(D_base, sigma_base, L_dias, base=base_key)
-    z_opt = norm.ppf(SL_opt / 100.0)
-    SS_opt = z_opt * sigma_L_opt
-    r_opt = mu_L_opt + SS_opt
-
-    z_base = norm.ppf(SL_base / 100.0)
-    SS_base_default = z_base * sigma_L_opt
-    if r_base_input and r_base_input > 0:
-        SS_base = max(0.0, r_base_input - mu_L_opt)
-        r_base = r_base_input
-    else:
-        SS_base = SS_base_default
-        r_base = mu_L_opt + SS_base
-
-    # EOQ na base do período e ajustes práticos
-    Q_opt_raw = eoq(D_base, K, h_per)
-    Q_opt = ajusta_por_moq_multiplo(Q_opt_raw, moq=moq, mult=mult)
+    # Estatísticas do lead time, SS, r e EOQ (ótimo e baseline) num único passo memoizado
+    pol = calcula_politica(D_base, sigma_base, L_dias, base_key, SL_opt, SL_base,
+                           K, h_per, moq, mult, r_base_input)
+    mu_L_opt, sigma_L_opt, d_dia, sigma_d_dia = pol.mu_L, pol.sigma_L, pol.d_dia, pol.sigma_d_dia
+    SS_opt, r_opt = pol.SS_opt, pol.r_opt
+    SS_base, r_base = pol.SS_base, pol.r_base
+    Q_opt_raw, Q_opt = pol.Q_opt_raw, pol.Q_opt
 
     # Custos por período + projeção anual (puramente informativa)
     cped_opt, cpos_opt, ctot_opt = custos_periodicos(Q_opt, D_base, K, h_per, SS=SS_opt)
@@ -400,84 +924,64 @@ if aba == "🔧 Calculadora":
     st.subheader("📈 Resultado – Política (Q, r)")
     colA, colB = st.columns(2)
 
-    with colA:
-        st.markdown("### ✅ Ótimo (algoritmo)")
-        st.markdown(
-        f"- **Quanto pedir (Q\\*)**: {Q_opt:,.0f} un  \n"
-        f"  <span style='color:gray'>Tamanho do pedido que minimiza o custo total por {periodo_label}.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Quando pedir (r)**: {r_opt:,.0f} un  \n"
-        f"  <span style='color:gray'>Gatilho: dispare quando a **posição de estoque** ≤ r "
-        f"(on-hand + em trânsito − backorders). Inclui demanda média no lead time + SS.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Estoque de segurança (SS)**: {SS_opt:,.0f} un  \n"
-        f"  <span style='color:gray'>‘Almofada’ estatística para cobrir a variabilidade durante o lead time.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Cobertura do lote**: {cobertura_opt:,.0f} dias  \n"
-        f"  <span style='color:gray'>Tempo médio que o lote Q\\* cobre o consumo.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Custo por {periodo_label} – Pedidos:** R$ {cped_opt:,.0f}  \n"
-        f"  <span style='color:gray'>= K·D/Q = {K:,.2f} × {D_base:,.0f} ÷ {Q_opt:,.0f} "
-        f"→ {n_ped_opt:,.2f} pedidos/{periodo_label}.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Custo por {periodo_label} – Posse:** R$ {cpos_opt:,.0f}  \n"
-        f"  <span style='color:gray'>= h·(Q/2 + SS) = {h_per:,.4f} × ({Q_opt:,.0f}/2 + {SS_opt:,.0f}) "
-        f"= {h_per:,.4f} × {hold_base_opt:,.0f}.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Custo por {periodo_label} – Total:** **R$ {ctot_opt:,.0f}**  \n"
-        f"  <span style='color:gray'>= (Pedidos) + (Posse) = {cped_opt:,.0f} + {cpos_opt:,.0f}.</span>",
-        unsafe_allow_html=True,
-    )
+    # números formatados uma única vez e reaproveitados nas duas colunas
+    txt = {
+        "Q_opt": fmt0(Q_opt), "r_opt": fmt0(r_opt), "SS_opt": fmt0(SS_opt),
+        "cob_opt": fmt0(cobertura_opt), "n_ped_opt": fmt2(n_ped_opt),
+        "cped_opt": fmt0(cped_opt), "cpos_opt": fmt0(cpos_opt), "ctot_opt": fmt0(ctot_opt),
+        "hold_opt": fmt0(hold_base_opt),
+        "Q_base": fmt0(Q_base), "r_base": fmt0(r_base), "SS_base": fmt0(SS_base),
+        "cob_base": fmt0(cobertura_base), "n_ped_base": fmt2(n_ped_base),
+        "cped_base": fmt0(cped_base), "cpos_base": fmt0(cpos_base), "ctot_base": fmt0(ctot_base),
+        "hold_base": fmt0(hold_base_base),
+        "K": fmt2(K), "D": fmt0(D_base), "h": f"{h_per:,.4f}",
+    }
 
+    with colA:
+        linhas_opt = [
+            "### ✅ Ótimo (algoritmo)",
+            f"- **Quanto pedir (Q\\*)**: {txt['Q_opt']} un  \n"
+            f"  <span style='color:gray'>Tamanho do pedido que minimiza o custo total por {periodo_label}.</span>",
+            f"- **Quando pedir (r)**: {txt['r_opt']} un  \n"
+            f"  <span style='color:gray'>Gatilho: dispare quando a **posição de estoque** ≤ r "
+            f"(on-hand + em trânsito − backorders). Inclui demanda média no lead time + SS.</span>",
+            f"- **Estoque de segurança (SS)**: {txt['SS_opt']} un  \n"
+            f"  <span style='color:gray'>‘Almofada’ estatística para cobrir a variabilidade durante o lead time.</span>",
+            f"- **Cobertura do lote**: {txt['cob_opt']} dias  \n"
+            f"  <span style='color:gray'>Tempo médio que o lote Q\\* cobre o consumo.</span>",
+            f"- **Custo por {periodo_label} – Pedidos:** R$ {txt['cped_opt']}  \n"
+            f"  <span style='color:gray'>= K·D/Q = {txt['K']} × {txt['D']} ÷ {txt['Q_opt']} "
+            f"→ {txt['n_ped_opt']} pedidos/{periodo_label}.</span>",
+            f"- **Custo por {periodo_label} – Posse:** R$ {txt['cpos_opt']}  \n"
+            f"  <span style='color:gray'>= h·(Q/2 + SS) = {txt['h']} × ({txt['Q_opt']}/2 + {txt['SS_opt']}) "
+            f"= {txt['h']} × {txt['hold_opt']}.</span>",
+            f"- **Custo por {periodo_label} – Total:** **R$ {txt['ctot_opt']}**  \n"
+            f"  <span style='color:gray'>= (Pedidos) + (Posse) = {txt['cped_opt']} + {txt['cpos_opt']}.</span>",
+        ]
+        # um único st.markdown por coluna (menos mensagens para o frontend)
+        st.markdown("\n".join(linhas_opt), unsafe_allow_html=True)
 
     with colB:
-        st.markdown("### 📌 Baseline (atual)")
-        st.markdown(
-        f"- **Quanto pedir (Q₀)**: {Q_base:,.0f} un  \n"
-        f"  <span style='color:gray'>Tamanho do pedido praticado hoje.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Quando pedir (r₀)**: {r_base:,.0f} un  \n"
-        f"  <span style='color:gray'>Gatilho atual. Se r₀ ≈ μ_L ⇒ SS₀ ≈ 0 (sem margem de segurança).</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Estoque de segurança (SS₀)**: {SS_base:,.0f} un  \n"
-        f"  <span style='color:gray'>Reserva do baseline (derivada de r₀ ou do SL baseline).</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(f"- **Cobertura do lote**: {cobertura_base:,.0f} dias")
-        st.markdown(
-        f"- **Custo por {periodo_label} – Pedidos:** R$ {cped_base:,.0f}  \n"
-        f"  <span style='color:gray'>= K·D/Q = {K:,.2f} × {D_base:,.0f} ÷ {Q_base:,.0f} "
-        f"→ {n_ped_base:,.2f} pedidos/{periodo_label}.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Custo por {periodo_label} – Posse:** R$ {cpos_base:,.0f}  \n"
-        f"  <span style='color:gray'>= h·(Q/2 + SS) = {h_per:,.4f} × ({Q_base:,.0f}/2 + {SS_base:,.0f}) "
-        f"= {h_per:,.4f} × {hold_base_base:,.0f}.</span>",
-        unsafe_allow_html=True,
-    )
-        st.markdown(
-        f"- **Custo por {periodo_label} – Total:** **R$ {ctot_base:,.0f}**  \n"
-        f"  <span style='color:gray'>= (Pedidos) + (Posse) = {cped_base:,.0f} + {cpos_base:,.0f}.</span>",
-        unsafe_allow_html=True,
-    )
-    
+        linhas_base = [
+            "### 📌 Baseline (atual)",
+            f"- **Quanto pedir (Q₀)**: {txt['Q_base']} un  \n"
+            f"  <span style='color:gray'>Tamanho do pedido praticado hoje.</span>",
+            f"- **Quando pedir (r₀)**: {txt['r_base']} un  \n"
+            f"  <span style='color:gray'>Gatilho atual. Se r₀ ≈ μ_L ⇒ SS₀ ≈ 0 (sem margem de segurança).</span>",
+            f"- **Estoque de segurança (SS₀)**: {txt['SS_base']} un  \n"
+            f"  <span style='color:gray'>Reserva do baseline (derivada de r₀ ou do SL baseline).</span>",
+            f"- **Cobertura do lote**: {txt['cob_base']} dias",
+            f"- **Custo por {periodo_label} – Pedidos:** R$ {txt['cped_base']}  \n"
+            f"  <span style='color:gray'>= K·D/Q = {txt['K']} × {txt['D']} ÷ {txt['Q_base']} "
+            f"→ {txt['n_ped_base']} pedidos/{periodo_label}.</span>",
+            f"- **Custo por {periodo_label} – Posse:** R$ {txt['cpos_base']}  \n"
+            f"  <span style='color:gray'>= h·(Q/2 + SS) = {txt['h']} × ({txt['Q_base']}/2 + {txt['SS_base']}) "
+            f"= {txt['h']} × {txt['hold_base']}.</span>",
+            f"- **Custo por {periodo_label} – Total:** **R$ {txt['ctot_base']}**  \n"
+            f"  <span style='color:gray'>= (Pedidos) + (Posse) = {txt['cped_base']} + {txt['cpos_base']}.</span>",
+        ]
+        st.markdown("\n".join(linhas_base), unsafe_allow_html=True)
+
     # difs por componente
     delta_ped = (cped_base - cped_opt) if (np.isfinite(cped_base) and np.isfinite(cped_opt)) else np.nan
     delta_pos = (cpos_base - cpos_opt) if (np.isfinite(cpos_base) and np.isfinite(cpos_opt)) else np.nan
@@ -575,22 +1079,22 @@ if aba == "🔧 Calculadora":
     st.subheader(f"💰 Custo por {periodo_label.capitalize()} vs. Tamanho do Lote (Q)")
 
     Q_grid_right = (Q_opt if np.isfinite(Q_opt) else max(Q_base, 100)) * 5
-    Q_grid = np.linspace(max(1, 0.2 * (Q_opt if np.isfinite(Q_opt) else Q_base)), Q_grid_right, 200)
-    total_grid = []
-    for Q in Q_grid:
-        _, _, ctot = custos_periodicos(Q, D_base, K, h_per, SS=SS_opt)  # usa SS do alvo para mesmo nível de serviço
-        total_grid.append(ctot)
-
-    fig1, ax1 = plt.subplots(figsize=(8, 4))
-    ax1.plot(Q_grid, total_grid, label=f"Custo por {periodo_label} (com SS alvo)")
+    Q_grid_left = max(1, 0.2 * (Q_opt if np.isfinite(Q_opt) else Q_base))
+    # usa SS do alvo para mesmo nível de serviço
+    Q_grid, total_grid = _cost_grid_cached(Q_grid_left, Q_grid_right, D_base, K, h_per, SS_opt)
+
+    fig1 = go.Figure(go.Scatter(
+        x=Q_grid, y=total_grid, mode="lines", name=f"Custo por {periodo_label} (com SS alvo)"
+    ))
     if np.isfinite(Q_opt):
-        ax1.axvline(Q_opt, linestyle='--', label=f"Q* (Ótimo) = {Q_opt:,.0f}")
-    ax1.axvline(Q_base, linestyle=':', label=f"Q₀ (Baseline) = {Q_base:,.0f}")
-    ax1.set_xlabel("Tamanho do lote (Q)")
-    ax1.set_ylabel(f"Custo por {periodo_label} (R$)")
-    ax1.set_title(f"Custo total por {periodo_label} vs. Q")
-    ax1.legend()
-    st.pyplot(fig1)
+        fig1.add_vline(x=Q_opt, line_dash="dash", annotation_text=f"Q* (Ótimo) = {Q_opt:,.0f}")
+    fig1.add_vline(x=Q_base, line_dash="dot", annotation_text=f"Q₀ (Baseline) = {Q_base:,.0f}")
+    fig1.update_layout(
+        title=f"Custo total por {periodo_label} vs. Q",
+        xaxis_title="Tamanho do lote (Q)",
+        yaxis_title=f"Custo por {periodo_label} (R$)",
+    )
+    st.plotly_chart(fig1, width="stretch")
 
     # ---------------- Gráfico serrilhado com lead time ----------------
     st.markdown("---")
@@ -600,95 +1104,126 @@ if aba == "🔧 Calculadora":
 
     sd_day = sigma_d_dia if usar_variabilidade else 0.0
     
-    # ÓTIMO
-    x1, y1_on, y1_pos, ord1, arr1, so1 = sim_serrilhado_com_leadtime(
-    Q=Q_opt if np.isfinite(Q_opt) else Q_base,
-    r=r_opt, d_dia=d_dia, L=L_dias,
-    sigma_d_dia=sd_day, T=T_sim, seed=1, start_mode="steady"
+    kpis_fechados = st.checkbox(
+        "KPIs analíticos (sem simulação)", value=False,
+        help=("Calcula risco de ruptura, falta esperada e fill rate por fórmula fechada "
+              "(demanda Normal no lead time), sem simular nem desenhar o gráfico.")
     )
-    # BASELINE
-    x2, y2_on, y2_pos, ord2, arr2, so2 = sim_serrilhado_com_leadtime(
-    Q=Q_base, r=r_base, d_dia=d_dia, L=L_dias,
-    sigma_d_dia=sd_day, T=T_sim, seed=2, start_mode="steady"
-    )
-
-    fig2, ax2 = plt.subplots(figsize=(8, 4))
-
-    # linhas principais
-    ax2.plot(x1, y1_on, label="On-hand Ótimo (Q*, r)")
-    ax2.plot(x2, y2_on, label="On-hand Baseline (Q₀, r₀)")
-
-    # posição (on-hand + em trânsito − backorders)
-    ax2.plot(x1, y1_pos, alpha=0.6, linewidth=1, label="Posição (Ótimo)")
-    ax2.plot(x2, y2_pos, alpha=0.6, linewidth=1, label="Posição (Baseline)")
-
-    # marcadores de eventos
-    if ord1:
-        ax2.scatter(ord1, [r_opt]*len(ord1), marker="v", s=40, label="Pedido emitido (Ótimo)")
-    if arr1:
-        ax2.scatter(arr1, [r_opt]*len(arr1), marker="*", s=80, label="Chegada (Ótimo)")
-    if ord2:
-        ax2.scatter(ord2, [r_base]*len(ord2), marker="v", s=40, label="Pedido emitido (Baseline)")
-    if arr2:
-        ax2.scatter(arr2, [r_base]*len(arr2), marker="*", s=80, label="Chegada (Baseline)")
-
-    # janelas de lead time (sombreamento suave)
-    for t0, t1 in zip(ord1, arr1):
-        ax2.axvspan(t0, t1, alpha=0.06)
-    for t0, t1 in zip(ord2, arr2):
-        ax2.axvspan(t0, t1, alpha=0.03)
-    
-    # referências
-    ax2.axhline(r_opt, ls='--', label="r (Ótimo)")
-    ax2.axhline(r_base, ls=':',  label="r₀ (Baseline)")
-    ax2.axhspan(SS_opt, r_opt, alpha=0.12, label="Zona de SS (Ótimo)")
-    ax2.axhline(0, lw=0.8)
-
-    ax2.set_xlabel("Dias")
-    ax2.set_ylabel("Unidades (on-hand)")
-    ax2.set_title(f"Ciclos de estoque com lead time – base {periodo_label}")
-    ax2.legend()
-    st.pyplot(fig2)
-
-    # ---------------- KPIs do ciclo ----------------
-    def _kpis(y_on, ords, arrs, SS):
-        y_on = np.asarray(y_on, dtype=float)
-        ords = np.asarray(ords)
-        arrs = np.asarray(arrs)
-        return {
-        "Pedidos no horizonte": int(len(ords)),
-        "Intervalo médio entre chegadas (dias)": (float(np.diff(arrs).mean()) if len(arrs) > 1 else np.nan),
-        "Estoque médio (un)": float(np.nanmean(y_on)),
-        "% dias abaixo de SS": float(100.0 * np.mean(y_on < SS)),
-        "% dias com ruptura": float(100.0 * np.mean(y_on <= 0)),
-        "Mín on-hand (un)": float(np.nanmin(y_on)),
-        "Máx on-hand (un)": float(np.nanmax(y_on)),
-        }
-
-    kpi_opt  = _kpis(y1_on, ord1, arr1, SS_opt)
-    kpi_base = _kpis(y2_on, ord2, arr2, SS_base)
 
-    colK1, colK2 = st.columns(2)
-    with colK1:
-        st.markdown("**KPIs do ciclo – Ótimo**")
-        st.markdown(
-            f"- Pedidos no horizonte: **{kpi_opt['Pedidos no horizonte']}**  \n"
-            f"- Intervalo médio entre chegadas: **{kpi_opt['Intervalo médio entre chegadas (dias)']:.1f} dias**  \n"
-            f"- Estoque médio: **{kpi_opt['Estoque médio (un)']:.0f} un**  \n"
-            f"- % dias abaixo de SS: **{kpi_opt['% dias abaixo de SS']:.1f}%**  \n"
-            f"- % dias com ruptura: **{kpi_opt['% dias com ruptura']:.1f}%**  \n"
-            f"- Mín on-hand: **{kpi_opt['Mín on-hand (un)']:.0f}** · Máx on-hand: **{kpi_opt['Máx on-hand (un)']:.0f}**"
+    if kpis_fechados:
+        sigma_L_kpi = sigma_L_opt if usar_variabilidade else 0.0
+        kpa_opt = kpis_analiticos(Q_opt if np.isfinite(Q_opt) else Q_base, r_opt,
+                                  mu_L_opt, sigma_L_kpi, d_dia, T_sim)
+        kpa_base = kpis_analiticos(Q_base, r_base, mu_L_opt, sigma_L_kpi, d_dia, T_sim)
+
+        colK1, colK2 = st.columns(2)
+        for col, nome, kpa in [(colK1, "Ótimo", kpa_opt), (colK2, "Baseline", kpa_base)]:
+            with col:
+                st.markdown(f"**KPIs analíticos – {nome}**")
+                st.markdown(
+                    f"- Pedidos esperados no horizonte: **{kpa['Pedidos no horizonte']:.1f}**  \n"
+                    f"- Estoque médio: **{kpa['Estoque médio (un)']:.0f} un**  \n"
+                    f"- Risco de ruptura por ciclo: **{kpa['Risco de ruptura por ciclo (%)']:.1f}%**  \n"
+                    f"- Falta esperada por ciclo: **{kpa['Falta esperada por ciclo (un)']:.1f} un**  \n"
+                    f"- Fill rate (unidades atendidas): **{kpa['Fill rate (%)']:.1f}%**"
+                )
+        st.caption(
+            "Risco de ruptura = 1 − Φ((r − μ_L)/σ_L). "
+            "Falta esperada por ciclo = σ_L·[φ(z) − z·(1 − Φ(z))]. Fill rate = 1 − falta/Q."
+        )
+    else:
+        # ÓTIMO (semente 1) e BASELINE (semente 2) numa única simulação em lote
+        x_sim, y_on_sim, y_pos_sim, ord_sim, arr_sim, so_sim = _sim_cached(
+        (Q_opt if np.isfinite(Q_opt) else Q_base, Q_base), (r_opt, r_base),
+        d_dia, L_dias, sd_day, T_sim, (1, 2), "steady"
+        )
+        x1 = x2 = x_sim
+        y1_on, y2_on = y_on_sim
+        y1_pos, y2_pos = y_pos_sim
+        ord1, ord2 = ord_sim
+        arr1, arr2 = arr_sim
+        so1, so2 = so_sim
+
+        # linhas principais
+        fig2 = go.Figure([
+            go.Scatter(x=x1, y=y1_on, mode="lines", name="On-hand Ótimo (Q*, r)"),
+            go.Scatter(x=x2, y=y2_on, mode="lines", name="On-hand Baseline (Q₀, r₀)"),
+            # posição (on-hand + em trânsito − backorders)
+            go.Scatter(x=x1, y=y1_pos, mode="lines", opacity=0.6, line_width=1, name="Posição (Ótimo)"),
+            go.Scatter(x=x2, y=y2_pos, mode="lines", opacity=0.6, line_width=1, name="Posição (Baseline)"),
+        ])
+
+        # marcadores de eventos
+        for tempos, nivel, simbolo, tamanho, nome in [
+            (ord1, r_opt, "triangle-down", 8, "Pedido emitido (Ótimo)"),
+            (arr1, r_opt, "star", 12, "Chegada (Ótimo)"),
+            (ord2, r_base, "triangle-down", 8, "Pedido emitido (Baseline)"),
+            (arr2, r_base, "star", 12, "Chegada (Baseline)"),
+        ]:
+            if len(tempos):
+                fig2.add_trace(go.Scatter(
+                    x=tempos, y=np.full(len(tempos), nivel), mode="markers",
+                    marker_symbol=simbolo, marker_size=tamanho, name=nome
+                ))
+
+        # janelas de lead time (sombreamento suave)
+        for t0, t1 in zip(ord1, arr1):
+            fig2.add_vrect(x0=t0, x1=t1, fillcolor="gray", opacity=0.06, line_width=0)
+        for t0, t1 in zip(ord2, arr2):
+            fig2.add_vrect(x0=t0, x1=t1, fillcolor="gray", opacity=0.03, line_width=0)
+
+        # referências
+        fig2.add_hline(y=r_opt, line_dash="dash", annotation_text="r (Ótimo)")
+        fig2.add_hline(y=r_base, line_dash="dot", annotation_text="r₀ (Baseline)")
+        fig2.add_hrect(y0=SS_opt, y1=r_opt, fillcolor="green", opacity=0.12, line_width=0,
+                       annotation_text="Zona de SS (Ótimo)", annotation_position="bottom left")
+        fig2.add_hline(y=0, line_width=0.8)
+
+        fig2.update_layout(
+            title=f"Ciclos de estoque com lead time – base {periodo_label}",
+            xaxis_title="Dias",
+            yaxis_title="Unidades (on-hand)",
+        )
+        st.plotly_chart(fig2, width="stretch")
+
+        # ---------------- KPIs do ciclo ----------------
+        def _kpis(y_on, ords, arrs, SS):
+            # y_on, ords e arrs já chegam como ndarray da simulação (sem NaN): sem cópias
+            v_min, v_max, media, pct_abaixo_ss, pct_ruptura = _kpis_core(y_on, float(SS))
+            return {
+            "Pedidos no horizonte": int(len(ords)),
+            "Intervalo médio entre chegadas (dias)": (float(np.diff(arrs).mean()) if len(arrs) > 1 else np.nan),
+            "Estoque médio (un)": float(media),
+            "% dias abaixo de SS": float(pct_abaixo_ss),
+            "% dias com ruptura": float(pct_ruptura),
+            "Mín on-hand (un)": float(v_min),
+            "Máx on-hand (un)": float(v_max),
+            }
+
+        kpi_opt  = _kpis(y1_on, ord1, arr1, SS_opt)
+        kpi_base = _kpis(y2_on, ord2, arr2, SS_base)
+
+        colK1, colK2 = st.columns(2)
+        with colK1:
+            st.markdown("**KPIs do ciclo – Ótimo**")
+            st.markdown(
+                f"- Pedidos no horizonte: **{kpi_opt['Pedidos no horizonte']}**  \n"
+                f"- Intervalo médio entre chegadas: **{kpi_opt['Intervalo médio entre chegadas (dias)']:.1f} dias**  \n"
+                f"- Estoque médio: **{kpi_opt['Estoque médio (un)']:.0f} un**  \n"
+                f"- % dias abaixo de SS: **{kpi_opt['% dias abaixo de SS']:.1f}%**  \n"
+                f"- % dias com ruptura: **{kpi_opt['% dias com ruptura']:.1f}%**  \n"
+                f"- Mín on-hand: **{kpi_opt['Mín on-hand (un)']:.0f}** · Máx on-hand: **{kpi_opt['Máx on-hand (un)']:.0f}**"
+            )
+        with colK2:
+            st.markdown("**KPIs do ciclo – Baseline**")
+            st.markdown(
+                f"- Pedidos no horizonte: **{kpi_base['Pedidos no horizonte']}**  \n"
+                f"- Intervalo médio entre chegadas: **{kpi_base['Intervalo médio entre chegadas (dias)']:.1f} dias**  \n"
+                f"- Estoque médio: **{kpi_base['Estoque médio (un)']:.0f} un**  \n"
+                f"- % dias abaixo de SS: **{kpi_base['% dias abaixo de SS']:.1f}%**  \n"
+                f"- % dias com ruptura: **{kpi_base['% dias com ruptura']:.1f}%**  \n"
+                f"- Mín on-hand: **{kpi_base['Mín on-hand (un)']:.0f}** · Máx on-hand: **{kpi_base['Máx on-hand (un)']:.0f}**"
         )
-    with colK2:
-        st.markdown("**KPIs do ciclo – Baseline**")
-        st.markdown(
-            f"- Pedidos no horizonte: **{kpi_base['Pedidos no horizonte']}**  \n"
-            f"- Intervalo médio entre chegadas: **{kpi_base['Intervalo médio entre chegadas (dias)']:.1f} dias**  \n"
-            f"- Estoque médio: **{kpi_base['Estoque médio (un)']:.0f} un**  \n"
-            f"- % dias abaixo de SS: **{kpi_base['% dias abaixo de SS']:.1f}%**  \n"
-            f"- % dias com ruptura: **{kpi_base['% dias com ruptura']:.1f}%**  \n"
-            f"- Mín on-hand: **{kpi_base['Mín on-hand (un)']:.0f}** · Máx on-hand: **{kpi_base['Máx on-hand (un)']:.0f}**"
-    )
 # ---------------------------
 # 📘 INTUIÇÃO
 # ---------------------------
@@ -772,27 +1307,9 @@ elif aba == "📂 Etapas da Modelagem Matemática":
     K = 120.0
     i_ano = 0.25
     v = 4.00
-    h_sem = (i_ano * v) / 52.0  # conversão para base semanal
 
-    Q = np.linspace(max(1, 0.05*D_sem), 8*D_sem, 400)  # grade de Q (un)
-    C_pedido = K * D_sem / Q                 # R$/semana
-    C_posse  = h_sem * Q / 2.0               # R$/semana
-    C_total  = C_pedido + C_posse            # R$/semana
-
-    Q_opt = np.sqrt(2 * K * D_sem / h_sem)   # EOQ em unidades (base semanal)
-    C_opt = K * D_sem / Q_opt + h_sem * Q_opt / 2.0
-
-    fig, ax = plt.subplots(figsize=(6,4))
-    ax.plot(Q, C_pedido, '--', label="Custo de Pedido (R$/sem)")
-    ax.plot(Q, C_posse, '--', label="Custo de Posse (R$/sem)")
-    ax.plot(Q, C_total, '-',  label="Custo Total (R$/sem)", linewidth=2)
-    ax.axvline(Q_opt, linestyle=':', label=f"Q* ≈ {Q_opt:,.0f} un")
-    ax.scatter([Q_opt], [C_opt], zorder=5)
-    ax.set_xlabel("Quantidade por Pedido (Q)  [un]")
-    ax.set_ylabel("Custo por Semana  [R$]")
-    ax.set_title("Curvas de Custo (base semanal) e Ponto Ótimo (EOQ)")
-    ax.legend()
-    st.pyplot(fig)
+    with _FIG_LOCK:
+        st.pyplot(make_eoq_plot(D_sem, K, i_ano, v), clear_figure=False)
 
     st.markdown("O ponto ótimo é aquele em que o custo do pedido é igual ao custo de manter o sku estocado e isso garante o custo total mínimo.")
 
@@ -821,8 +1338,6 @@ Jair quer saber quanto deveria pedir **por semana** e **quando** disparar o pedi
 """)
 
     # --- Cálculos do caso (base SEMANAL) ---
-    import math
-    from scipy.stats import norm
 
     D_sem = 600.0
     sigma_sem = 180.0
@@ -831,7 +1346,7 @@ Jair quer saber quanto deveria pedir **por semana** e **quando** disparar o pedi
     v = 5.0
     i_ano = 0.30
     h_sem = (i_ano * v) / 52.0               # R$/un/sem
-    z = norm.ppf(0.95)                       # nível de serviço 95%
+    z = ndtri(0.95)                          # nível de serviço 95%
 
     # EOQ (quanto pedir) – base semanal
     Q_opt = math.sqrt(2 * K * D_sem / h_sem)
@@ -847,11 +1362,6 @@ Jair quer saber quanto deveria pedir **por semana** e **quando** disparar o pedi
     # Baseline
     Q_base = 5000.0
     # Para comparar em mesmo nível de serviço, usamos o mesmo SS calculado acima
-    def custo_semanal(Q, K, D_sem, h_sem, SS):
-        C_ped = K * D_sem / Q
-        C_pos = h_sem * (Q / 2.0 + SS)
-        return C_ped, C_pos, (C_ped + C_pos)
-
     Cped_opt, Cpos_opt, Ctot_opt = custo_semanal(Q_opt, K, D_sem, h_sem, SS)
     Cped_base, Cpos_base, Ctot_base = custo_semanal(Q_base, K, D_sem, h_sem, SS)
 
@@ -902,20 +1412,8 @@ Jair quer saber quanto deveria pedir **por semana** e **quando** disparar o pedi
     """)
 
     # Gráfico opcional (custo x Q) para visualizar o ganho neste caso
-    import numpy as np
-    Q_grid = np.linspace(max(200, 0.2*Q_opt), 2.5*Q_base, 250)
-    C_grid = [custo_semanal(q, K, D_sem, h_sem, SS)[2] for q in Q_grid]
-
-    import matplotlib.pyplot as plt
-    fig, ax = plt.subplots(figsize=(8, 4))
-    ax.plot(Q_grid, C_grid, label="Custo semanal total (com SS)")
-    ax.axvline(Q_opt, ls='--', label=f"Q* ≈ {Q_opt:,.0f}")
-    ax.axvline(Q_base, ls=':', label=f"Q₀ (baseline) = {Q_base:,.0f}")
-    ax.set_xlabel("Tamanho do lote (Q)")
-    ax.set_ylabel("Custo por semana (R$)")
-    ax.set_title("Custo semanal vs. Q — Ótimo x Baseline")
-    ax.legend()
-    st.pyplot(fig)
+    with _FIG_LOCK:
+        st.pyplot(make_exemplo_plot(Q_opt, Q_base, K, D_sem, h_sem, SS), clear_figure=False)
 
 # ---------------------------
 # 📑 MULTI-SKU & UPLOAD
@@ -961,7 +1459,6 @@ elif aba == "📑 Multi-SKU & Upload":
         help="Selecione se as colunas do ERP estão em base mensal ou semanal."
     )
     base_key_multi = "mensal" if base_tempo_multi == "Mensal" else "semanal"
-    periods_per_year_multi = 12 if base_key_multi == "mensal" else 52
     periodo_label_multi = "mês" if base_key_multi == "mensal" else "semana"
 
     aplicar_restricoes = st.sidebar.checkbox("Aplicar MOQ e Múltiplo do ERP", value=True)
@@ -981,17 +1478,109 @@ elif aba == "📑 Multi-SKU & Upload":
         st.info("🧭 Aguardando o Excel do ERP…")
         st.stop()
 
+    # Colunas numéricas conhecidas do layout do ERP: já saem do leitor em float64
+    colunas_numericas = {
+        "Demanda_mensal", "Desvio_mensal", "Demanda_semanal", "Desvio_semanal",
+        "Preco_unitario", "Taxa_carrying_anual", "Custo_pedido", "Lead_time_dias",
+        "MOQ", "Multiplo", "SL", "Q_base", "r_base",
+    }
+
+    def para_float(x):
+        """Como pd.to_numeric(errors="coerce") para uma célula."""
+        if x is None:
+            return np.nan
+        try:
+            return float(x)
+        except (TypeError, ValueError):
+            return np.nan
+
+    def read_xlsx_streaming(file):
+        """
+        Lê o .xlsx linha a linha (openpyxl read_only) direto em arrays NumPy:
+        float64 para as colunas numéricas conhecidas, texto para o SKU.
+        Evita a inferência de tipos do pd.read_excel.
+        """
+        from openpyxl import load_workbook
+        wb = load_workbook(file, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            linhas = ws.iter_rows(values_only=True)
+            cab = next(linhas, None)
+            if cab is None:
+                return pd.DataFrame()
+            while cab and cab[-1] is None:  # colunas vazias à direita
+                cab = cab[:-1]
+            nomes, vistos = [], {}
+            for j, c in enumerate(cab):
+                c = f"Unnamed: {j}" if c is None else c
+                if c in vistos:  # mesmo critério do pandas para nomes repetidos
+                    vistos[c] += 1; c = f"{c}.{vistos[c]}"
+                else:
+                    vistos[c] = 0
+                nomes.append(c)
+            ncol = len(nomes)
+            numerica = [c in colunas_numericas for c in nomes]
+
+            cap = max((ws.max_row or 0) - 1, 16)  # dimensão declarada na planilha (pode faltar)
+            cols = [np.empty(cap, dtype=np.float64) if numerica[j] else np.empty(cap, dtype=object)
+                    for j in range(ncol)]
+            n = n_util = 0
+            for linha in linhas:
+                if n == cap:
+                    cap *= 2
+                    cols = [np.resize(a, cap) for a in cols]
+                vazia = True
+                for j in range(ncol):
+                    x = linha[j] if j < len(linha) else None
+                    if x is not None:
+                        vazia = False
+                    cols[j][n] = para_float(x) if numerica[j] else x
+                n += 1
+                if not vazia:
+                    n_util = n  # linhas vazias no fim são descartadas (como no pandas)
+        finally:
+            wb.close()
+
+        dados = {}
+        for j, c in enumerate(nomes):
+            a = cols[j][:n_util]
+            if c == "SKU":
+                a = sku_como_texto(a)
+            dados[c] = a
+        return pd.DataFrame(dados)
+
+    def sku_como_texto(a):
+        """SKU em texto, igual ao que pd.read_excel(...).astype(str) produziria."""
+        preenchidos = [x for x in a if x is not None]
+        so_numeros = all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in preenchidos)
+        # coluna só numérica com vazios ou decimais vira float64 no pandas ("1001.0")
+        como_float = so_numeros and (len(preenchidos) < len(a)
+                                     or any(isinstance(x, float) and not x.is_integer() for x in preenchidos))
+        out = np.empty(len(a), dtype=object)
+        for i, x in enumerate(a):
+            if x is None:
+                out[i] = np.nan  # astype(str) decide, como faria com o read_excel
+            elif como_float:
+                out[i] = str(float(x))
+            elif isinstance(x, float) and x.is_integer():
+                out[i] = str(int(x))
+            else:
+                out[i] = str(x)
+        return out
+
     def read_excel_safely(file):
         name = (file.name or "").lower()
         if name.endswith(".xlsx"):
             try:
                 import openpyxl  # noqa: F401
-                return pd.read_excel(file, engine="openpyxl")
+                return read_xlsx_streaming(file)
             except ImportError:
                 st.warning("⚠️ 'openpyxl' não encontrado. Tentando engine padrão do pandas.")
+                file.seek(0)
                 return pd.read_excel(file)
             except Exception as e:
                 st.warning(f"Falha com 'openpyxl': {e}. Tentando engine padrão.")
+                file.seek(0)
                 return pd.read_excel(file)
         elif name.endswith(".xls"):
             try:
@@ -1007,8 +1596,20 @@ elif aba == "📑 Multi-SKU & Upload":
             st.error("Formato não suportado. Use .xlsx ou .xls.")
             st.stop()
 
+    @st.cache_data(show_spinner=False, max_entries=8)
+    def load_erp(_file_bytes, chave_arquivo, name):
+        """Lê o Excel do ERP uma única vez por conteúdo enviado (chave = md5 + nome;
+        os bytes não entram no hash)."""
+        buf = BytesIO(_file_bytes)
+        buf.name = name
+        return read_excel_safely(buf)
+
+    import hashlib
+    file_bytes = up.getvalue()
+    chave_arquivo = hashlib.md5(file_bytes).hexdigest()
+
     try:
-        df_raw = read_excel_safely(up)
+        df_raw = load_erp(file_bytes, chave_arquivo, up.name)
     except Exception as e:
         st.error(f"❌ Não foi possível ler o Excel: {e}")
         st.stop()
@@ -1024,115 +1625,95 @@ elif aba == "📑 Multi-SKU & Upload":
         st.error(f"Colunas faltando no Excel do ERP: {missing}")
         st.stop()
 
-    has_Qbase = "Q_base" in df_raw.columns
-    has_rbase = "r_base" in df_raw.columns
-
-    def eoq(D_per, K, h_per):
-        if D_per is None or D_per <= 0 or K < 0 or h_per <= 0: return np.nan
-        return np.sqrt((2.0 * K * D_per) / h_per)
+    def num_compacto(col):
+        """
+        Coluna numérica em float32 quando a conversão não altera nenhum valor
+        (lead time, SL, MOQ, múltiplo, preços redondos…); senão fica em float64.
+        O Q* = √(2KD/h) toleraria o float32, mas a economia é diferença de dois
+        custos grandes e o erro apareceria nas duas casas decimais.
+        """
+        x = pd.to_numeric(col, errors="coerce")
+        x32 = x.astype(np.float32)
+        if np.array_equal(x32.to_numpy(np.float64), x.to_numpy(np.float64), equal_nan=True):
+            return x32
+        return x
+
+    @st.cache_data(show_spinner=False, max_entries=16)
+    def compute_results(_df_raw, chave_arquivo, base_key, aplicar_restricoes, heuristica, usa_numba):
+        """
+        Tabela de resultados (uma linha por SKU) para o arquivo e parâmetros dados.
+        _df_raw não é hasheado: chave_arquivo (MD5 do upload) o identifica.
+        usa_numba escolhe o núcleo compilado em paralelo; senão, NumPy vetorizado.
+        """
+        df_raw = _df_raw
+        periods_per_year = 12 if base_key == "mensal" else 52
+        periodo_label = "mês" if base_key == "mensal" else "semana"
 
-    def custos_periodicos(Q, D_per, K, h_per, SS=0.0):
-        if Q is None or Q <= 0 or D_per <= 0 or h_per < 0 or K < 0: return np.nan, np.nan, np.nan
-        c_ped = K * D_per / Q
-        c_pos = h_per * (Q / 2.0 + max(0.0, SS))
-        return c_ped, c_pos, c_ped + c_pos
+        has_Qbase = "Q_base" in df_raw.columns
+        has_rbase = "r_base" in df_raw.columns
 
-    def lead_time_stats_from_base(D_base, sigma_base, L_dias, base="mensal"):
-        if base == "semanal":
-            d_dia = D_base / 7.0; sigma_d_dia = sigma_base / np.sqrt(7.0)
-        else:
-            d_dia = D_base / 30.0; sigma_d_dia = sigma_base / np.sqrt(30.0)
-        mu_L = d_dia * L_dias
-        sigma_L = sigma_d_dia * np.sqrt(max(L_dias, 1))
-        return mu_L, sigma_L, d_dia, sigma_d_dia
-
-    def ajusta_por_moq_multiplo(q, moq=0, mult=0):
-        if q is None or np.isnan(q): return q
-        q_adj = float(q)
-        if moq and moq > 0 and q_adj < moq: q_adj = float(moq)
-        if mult and mult > 0: q_adj = float(mult) * np.ceil(q_adj / float(mult))
-        return q_adj
-
-    D_col = "Demanda_mensal" if base_key_multi == "mensal" else "Demanda_semanal"
-    S_col = "Desvio_mensal"  if base_key_multi == "mensal" else "Desvio_semanal"
-
-    df = pd.DataFrame({
-        "SKU": df_raw["SKU"].astype(str),
-        "D_per": pd.to_numeric(df_raw[D_col], errors="coerce"),
-        "sigma_per": pd.to_numeric(df_raw[S_col], errors="coerce"),
-        "v": pd.to_numeric(df_raw["Preco_unitario"], errors="coerce"),
-        "i_anual": pd.to_numeric(df_raw["Taxa_carrying_anual"], errors="coerce"),
-        "K": pd.to_numeric(df_raw["Custo_pedido"], errors="coerce"),
-        "L_dias": pd.to_numeric(df_raw["Lead_time_dias"], errors="coerce"),
-        "MOQ": pd.to_numeric(df_raw["MOQ"], errors="coerce"),
-        "Multiplo": pd.to_numeric(df_raw["Multiplo"], errors="coerce"),
-        "SL": pd.to_numeric(df_raw["SL"], errors="coerce"),
-        "Q_base": pd.to_numeric(df_raw["Q_base"], errors="coerce") if has_Qbase else np.nan,
-        "r_base": pd.to_numeric(df_raw["r_base"], errors="coerce") if has_rbase else np.nan,
-    })
-    df[["MOQ", "Multiplo"]] = df[["MOQ", "Multiplo"]].fillna(0.0)
-
-    results = []
-    for _, r in df.iterrows():
-        SKU = r["SKU"]; D_per = float(r["D_per"]); sigma_per = float(r["sigma_per"])
-        v = float(r["v"]); i_anual = float(r["i_anual"]); K = float(r["K"])
-        L = float(r["L_dias"]); SL = float(r["SL"]); moq = float(r["MOQ"]); mult = float(r["Multiplo"])
-        Qb_in = r["Q_base"]; rb_in = r["r_base"]
-
-        h_per = (i_anual * v) / periods_per_year_multi
-        mu_L, sigma_L, d_dia, sigma_d_dia = lead_time_stats_from_base(D_per, sigma_per, L, base=base_key_multi)
-        z = norm.ppf(np.clip(SL / 100.0, 0.01, 0.999))
-        SS_opt = z * sigma_L; r_opt = mu_L + SS_opt
-
-        Q_opt_raw = eoq(D_per, K, h_per)
-        Q_opt = ajusta_por_moq_multiplo(Q_opt_raw, moq if aplicar_restricoes else 0, mult if aplicar_restricoes else 0)
-
-        if pd.notna(Qb_in) and Qb_in > 0:
-            Q_base = float(Qb_in)
-        else:
-            if heuristica_baseline.startswith("Q₀ = Demanda por"): Q_base = D_per
-            elif heuristica_baseline.startswith("Q₀ = 2×"):        Q_base = 2.0 * D_per
-            else:
-                Q_base = ajusta_por_moq_multiplo(Q_opt_raw, moq if aplicar_restricoes else 0, mult if aplicar_restricoes else 0)
-        if aplicar_restricoes:
-            Q_base = ajusta_por_moq_multiplo(Q_base, moq, mult)
+        D_col = "Demanda_mensal" if base_key == "mensal" else "Demanda_semanal"
+        S_col = "Desvio_mensal"  if base_key == "mensal" else "Desvio_semanal"
 
-        if pd.notna(rb_in) and rb_in > 0:
-            r_base = float(rb_in); SS_base = max(0.0, r_base - mu_L)
+        # Todas as colunas numéricas convertidas numa passada só (nome no ERP → nome interno)
+        num_cols = {
+            D_col: "D_per", S_col: "sigma_per", "Preco_unitario": "v", "Taxa_carrying_anual": "i_anual",
+            "Custo_pedido": "K", "Lead_time_dias": "L_dias", "MOQ": "MOQ", "Multiplo": "Multiplo", "SL": "SL",
+        }
+        if has_Qbase: num_cols["Q_base"] = "Q_base"
+        if has_rbase: num_cols["r_base"] = "r_base"
+        num_df = df_raw[list(num_cols)].apply(num_compacto).rename(columns=num_cols)
+        df = pd.concat([df_raw["SKU"].astype(str).astype("category"), num_df], axis=1)
+        for c in ("Q_base", "r_base"):
+            if c not in df.columns:
+                df[c] = np.float32(np.nan)
+        df[["MOQ", "Multiplo"]] = df[["MOQ", "Multiplo"]].fillna(0.0)
+
+        # Estrutura de arrays (SoA): um array contíguo por grandeza, com o nome do
+        # argumento dos núcleos (passados por nome, não por posição). Contas sempre
+        # em float64: o float32 acima volta sem perda e fica só nas colunas de
+        # entrada do resultado (que vai para o cache).
+        soa = {nome: np.ascontiguousarray(df[col].to_numpy(dtype=np.float64))
+               for nome, col in (("D_per", "D_per"), ("sigma_per", "sigma_per"), ("v", "v"),
+                                 ("i_anual", "i_anual"), ("K", "K"), ("L", "L_dias"), ("SL", "SL"),
+                                 ("moq", "MOQ"), ("mult", "Multiplo"), ("Qb_in", "Q_base"), ("rb_in", "r_base"))}
+
+        if heuristica.startswith("Q₀ = Demanda por"): heur = 0
+        elif heuristica.startswith("Q₀ = 2×"):        heur = 1
+        else:                                          heur = 2
+
+        denom = 30.0 if base_key == "mensal" else 7.0
+        if usa_numba:
+            with _NUMBA_LOCK:
+                res = _multi_sku_numba(**soa, denom=denom, periods_per_year=float(periods_per_year),
+                                       heuristica=heur, aplicar_restricoes=aplicar_restricoes)
         else:
-            SS_base = z * sigma_L; r_base = mu_L + SS_base
-
-        cped_opt, cpos_opt, ctot_opt = custos_periodicos(Q_opt, D_per, K, h_per, SS=SS_opt)
-        cped_base, cpos_base, ctot_base = custos_periodicos(Q_base, D_per, K, h_per, SS=SS_base)
-
-        economia_per = ctot_base - ctot_opt if np.isfinite(ctot_base) and np.isfinite(ctot_opt) else np.nan
-        economia_ano = economia_per * periods_per_year_multi if np.isfinite(economia_per) else np.nan
-        economia_pct = (economia_per / ctot_base * 100.0) if (np.isfinite(ctot_base) and ctot_base > 0) else np.nan
-
-        results.append({
-            "SKU": SKU,
-            f"Demanda_{periodo_label_multi}": D_per,
-            f"σ_{periodo_label_multi}": sigma_per,
-            "v (R$)": v,
-            "i anual": i_anual,
-            "K (R$)": K,
-            "L (dias)": L,
-            "SL (%)": SL,
-            "MOQ": moq,
-            "Múltiplo": mult,
-            "Q* (ótimo)": np.round(Q_opt, 2),
-            "r (ótimo)": np.round(r_opt, 2),
-            "SS (ótimo)": np.round(SS_opt, 2),
-            "Q₀ (baseline)": np.round(Q_base, 2),
-            "r₀ (baseline)": np.round(r_base, 2),
-            f"Custo_{periodo_label_multi}_ótimo (R$)": np.round(ctot_opt, 2),
-            f"Custo_{periodo_label_multi}_baseline (R$)": np.round(ctot_base, 2),
-            f"Economia_{periodo_label_multi} (R$)": np.round(economia_per, 2),
-            "Economia_anual (R$)": np.round(economia_ano, 2),
-            "Economia (%)": np.round(economia_pct, 2),
-        })
-
-    df_out = pd.DataFrame(results)
+            res = multi_sku_numpy(**soa, denom=denom, periods_per_year=periods_per_year,
+                                  heuristica=heur, aplicar_restricoes=aplicar_restricoes)
+        for arr in res:  # os arrays de resultado são novos: arredonda no próprio buffer
+            np.round(arr, 2, out=arr)
+
+        colunas = [
+            "SKU", f"Demanda_{periodo_label}", f"σ_{periodo_label}", "v (R$)", "i anual",
+            "K (R$)", "L (dias)", "SL (%)", "MOQ", "Múltiplo",
+            "Q* (ótimo)", "r (ótimo)", "SS (ótimo)", "Q₀ (baseline)", "r₀ (baseline)",
+            f"Custo_{periodo_label}_ótimo (R$)", f"Custo_{periodo_label}_baseline (R$)",
+            f"Economia_{periodo_label} (R$)", "Economia_anual (R$)", "Economia (%)",
+        ]
+        entradas = [df[c].to_numpy() for c in ("D_per", "sigma_per", "v", "i_anual", "K", "L_dias", "SL", "MOQ", "Multiplo")]
+        arrays = (df["SKU"].array, *entradas, *res)
+        return pd.DataFrame({col: arr for col, arr in zip(colunas, arrays)})
+
+    # Cálculo de poucas operações por SKU: até catálogos grandes o NumPy vetorizado
+    # é limitado por memória e basta; acima do limiar compensa o núcleo numba em paralelo
+    n_skus = len(df_raw)
+    usa_numba = _HAS_NUMBA and n_skus > _LIMIAR_NUMBA
+    if usa_numba:
+        st.info(f"⚙️ {n_skus:,} SKUs: cálculo no núcleo compilado (numba, em paralelo) em vez do NumPy vetorizado.")
+    elif n_skus > _LIMIAR_NUMBA:
+        st.info(f"⚙️ {n_skus:,} SKUs: instale o 'numba' para usar o cálculo compilado em paralelo em arquivos grandes.")
+
+    df_out = compute_results(df_raw, chave_arquivo, base_key_multi, aplicar_restricoes, heuristica_baseline, usa_numba)
 
     st.subheader("🏆 Ranking de Economia (maior → menor)")
     ordenar_por = st.selectbox(
@@ -1140,48 +1721,110 @@ elif aba == "📑 Multi-SKU & Upload":
         [f"Economia_{periodo_label_multi} (R$)", "Economia_anual (R$)", "Economia (%)"],
         index=1, key="ordenar_por_multi"
     )
-    df_rank = df_out.sort_values(by=ordenar_por, ascending=False).reset_index(drop=True)
+    top_n = st.slider("Top N (linhas exibidas no ranking)", 10, 500, 100, step=10, key="top_n_multi")
 
     filtro_texto = st.text_input("Filtrar por SKU (contém):", "", key="filtro_sku_multi")
-    if filtro_texto:
-        df_rank = df_rank[df_rank["SKU"].str.contains(filtro_texto, case=False, na=False)]
+    colunas_economia = (f"Economia_{periodo_label_multi} (R$)", "Economia_anual (R$)", "Economia (%)")
+    chave_calculo = f"{chave_arquivo}|{base_key_multi}|{aplicar_restricoes}|{heuristica_baseline}"
+    df_rank, idx_filtrado, (soma_econ_per, soma_econ_ano, med_econ_pct) = ranking_top_n(
+        df_out, chave_calculo, ordenar_por, filtro_texto, top_n, colunas_economia
+    )
 
     st.dataframe(df_rank, use_container_width=True)
 
     colk1, colk2, colk3 = st.columns(3)
-    soma_econ_per = pd.to_numeric(df_rank[f"Economia_{periodo_label_multi} (R$)"], errors="coerce").replace([np.inf, -np.inf], np.nan).sum(skipna=True)
-    soma_econ_ano = pd.to_numeric(df_rank["Economia_anual (R$)"], errors="coerce").replace([np.inf, -np.inf], np.nan).sum(skipna=True)
-    med_econ_pct = pd.to_numeric(df_rank["Economia (%)"], errors="coerce").replace([np.inf, -np.inf], np.nan).mean(skipna=True)
-
     colk1.metric(f"Economia total por {periodo_label_multi}", f"R$ {soma_econ_per:,.2f}")
     colk2.metric("Economia total anual", f"R$ {soma_econ_ano:,.2f}")
     colk3.metric("Economia média (%)", f"{med_econ_pct:,.2f}%")
 
     st.caption("📌 Economia = Custo Baseline − Custo Ótimo (mesmo SL). Custo = K·D/Q + h·(Q/2 + SS).")
 
-    buf_xlsx = BytesIO()
-    engine_name = "xlsxwriter"
-    try:
-        import xlsxwriter
-    except Exception:
+    # Engine detectada de antemão (sem importar): xlsxwriter → openpyxl → CSV
+    import importlib.util
+    if importlib.util.find_spec("xlsxwriter"):
+        engine_name = "xlsxwriter"
+    elif importlib.util.find_spec("openpyxl"):
         engine_name = "openpyxl"
         st.warning("Usando engine 'openpyxl' para exportação (XlsxWriter indisponível).")
+    else:
+        engine_name = None
+        st.warning("Nenhuma engine de Excel disponível (XlsxWriter/openpyxl). Exportando em CSV.")
 
-    try:
-        with pd.ExcelWriter(buf_xlsx, engine=engine_name) as writer:
-            df_rank.to_excel(writer, index=False, sheet_name="ranking")
-            df_out.to_excel(writer, index=False, sheet_name="calculos")
-    except Exception as e:
-        st.warning(f"Falha ao usar engine '{engine_name}'. Tentando engine padrão. Detalhe: {e}")
-        buf_xlsx = BytesIO()
-        with pd.ExcelWriter(buf_xlsx) as writer:
-            df_rank.to_excel(writer, index=False, sheet_name="ranking")
-            df_out.to_excel(writer, index=False, sheet_name="calculos")
-
-    st.download_button(
-        label="💾 Baixar resultado (Excel)",
-        data=buf_xlsx.getvalue(),
-        file_name="resultado_multi_sku.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="download_multi"
-    )
\ No newline at end of file
+    def linhas_excel(df):
+        """Linhas prontas para o Excel: NaN vira célula vazia e ±inf vira texto (como no pandas)."""
+        for linha in df.itertuples(index=False, name=None):
+            yield [None if (isinstance(x, float) and x != x)
+                   else (str(x) if isinstance(x, float) and math.isinf(x) else x)
+                   for x in linha]
+
+    def escreve_excel_streaming(buf, planilhas, engine):
+        """
+        Grava as planilhas linha a linha, sem manter todas as células em memória:
+        xlsxwriter em 'constant_memory' ou openpyxl em 'write_only'.
+        (O pd.ExcelWriter escreve coluna a coluna, o que o constant_memory não aceita.)
+        """
+        if engine == "xlsxwriter":
+            import xlsxwriter
+            wb = xlsxwriter.Workbook(buf, {"constant_memory": True})
+            negrito = wb.add_format({"bold": True})
+            for nome, df in planilhas.items():
+                ws = wb.add_worksheet(nome)
+                ws.write_row(0, 0, [str(c) for c in df.columns], negrito)
+                for i, linha in enumerate(linhas_excel(df), start=1):
+                    ws.write_row(i, 0, linha)
+            wb.close()
+        else:
+            from openpyxl import Workbook
+            from openpyxl.cell import WriteOnlyCell
+            from openpyxl.styles import Font
+            wb = Workbook(write_only=True)
+            for nome, df in planilhas.items():
+                ws = wb.create_sheet(nome)
+                cabecalho = []
+                for c in df.columns:
+                    cel = WriteOnlyCell(ws, value=str(c)); cel.font = Font(bold=True)
+                    cabecalho.append(cel)
+                ws.append(cabecalho)
+                for linha in linhas_excel(df):
+                    ws.append(linha)
+            wb.save(buf)
+
+    # a aba "ranking" leva o conjunto filtrado inteiro, não só o Top N exibido
+    df_rank_completo = (df_out.loc[idx_filtrado]
+                        .sort_values(by=ordenar_por, ascending=False)
+                        .reset_index(drop=True))
+
+    buf_xlsx = None
+    if engine_name is not None:
+        try:
+            buf_xlsx = BytesIO()
+            escreve_excel_streaming(buf_xlsx, {"ranking": df_rank_completo, "calculos": df_out}, engine_name)
+        except Exception as e:
+            st.warning(f"Falha ao gerar o Excel com '{engine_name}'. Exportando em CSV. Detalhe: {e}")
+            buf_xlsx = None
+
+    if buf_xlsx is not None:
+        st.download_button(
+            label="💾 Baixar resultado (Excel)",
+            data=buf_xlsx.getvalue(),
+            file_name="resultado_multi_sku.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key="download_multi"
+        )
+    else:
+        # CSV tem uma tabela por arquivo: cálculos e ranking saem em downloads separados
+        col_csv1, col_csv2 = st.columns(2)
+        col_csv1.download_button(
+            label="💾 Baixar resultado (CSV)",
+            data=df_out.to_csv(index=False).encode("utf-8"),
+            file_name="resultado_multi_sku.csv",
+            mime="text/csv",
+            key="download_multi"
+        )
+        col_csv2.download_button(
+            label="💾 Baixar ranking (CSV)",
+            data=df_rank_completo.to_csv(index=False).encode("utf-8"),
+            file_name="ranking_multi_sku.csv",
+            mime="text/csv",
+            key="download_multi_ranking"
+        )
\ No newline at end of file